@@ -1,23 +1,33 @@
-from fastapi import FastAPI, HTTPException, Depends, Request, status
+from fastapi import FastAPI, HTTPException, Depends, Request, Response, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from pydantic import BaseModel
 from typing import List, Dict, Optional
 import uvicorn
-from groq import Groq
+from groq import AsyncGroq
+import httpx
 import re
-import json
+import orjson
 import os
-import time
+import asyncio
+import hashlib
 import logging
+import time
+from collections import deque
+from functools import lru_cache
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 import jwt
 from fastapi_limiter import FastAPILimiter
 from fastapi_limiter.depends import RateLimiter
-from fastapi.responses import JSONResponse
-from functools import lru_cache
+from fastapi.responses import ORJSONResponse
 from redis import asyncio as aioredis
+from medicine_patterns import (
+    STRENGTH_RE, FORM_RE, TOKEN_RULES, components_from_tokens,
+    fast_path_components, is_valid_components, LocalCache,
+    HTTP_LIMITS, HTTP_TIMEOUT
+)
 
 # Load environment variables
 load_dotenv()
@@ -33,9 +43,14 @@ logger = logging.getLogger(__name__)
 app = FastAPI(
     title="Medicine Parser API",
     description="API for parsing medicine names using Groq",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
+# Compress larger responses; batch results repeat the same keys for every
+# medicine. Added before CORS so it sits inside it in the middleware stack
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -50,6 +65,45 @@ security = HTTPBearer()
 SECRET_KEY = os.getenv('JWT_SECRET_KEY', 'your-secret-key')
 ALGORITHM = "HS256"
 
+# Service accounts rate limited in-process instead of through Redis
+TRUSTED_USERNAMES = {u.strip() for u in os.getenv('TRUSTED_USERNAMES', '').split(',') if u.strip()}
+
+# Maximum number of in-flight Groq requests per batch
+GROQ_CONCURRENCY = int(os.getenv('GROQ_CONCURRENCY', 10))
+
+# Parsed medicines are shared across workers through Redis
+CACHE_PREFIX = "med:v2:"
+CACHE_TTL = int(os.getenv('CACHE_TTL', 30 * 86400))
+
+# Shared by the rate limiter and the cache; callers wait for a free connection
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', 64))
+
+# Joins a batch of names so the tokenizer runs once per batch; it is
+# neither whitespace nor a word character, so no pattern can match across it
+_BATCH_SEP = '\x00'
+_SCANNER = re.Scanner(
+    [(re.escape(_BATCH_SEP), lambda scanner, token: ('separator', token))] + TOKEN_RULES,
+    re.IGNORECASE
+)
+
+# Groq prompts; only the user message varies per medicine
+_SYSTEM_MSG = {"role": "system", "content": "You are an expert in parsing medical product names. Extract components accurately."}
+_USER_TMPL = """Given the medicine name "{s}", extract the following components:
+1. Medicine name (without strength and formulation)
+2. Strength (with units)
+3. Formulation
+
+Return the result in JSON format like this:
+{{
+    "name": "medicine name",
+    "strength": "strength with units",
+    "formulation": "formulation type"
+}}
+
+Be precise and only include the exact information present in the input."""
+# The reply is a small JSON object, so a tight cap keeps tail latency down
+_MAX_TOKENS = 80
+
 # Pydantic models
 class TokenData(BaseModel):
     username: str
@@ -69,17 +123,15 @@ class ParsedMedicine(BaseModel):
 class MedicineList(BaseModel):
     medicines: List[Medicine]
 
-class ParsedMedicineList(BaseModel):
-    medicines: List[ParsedMedicine]
-
 # Redis setup
 async def create_redis_pool():
-    redis = await aioredis.from_url(
+    pool = aioredis.BlockingConnectionPool.from_url(
         f"redis://{os.getenv('REDIS_HOST', 'localhost')}:{os.getenv('REDIS_PORT', 6379)}/0",
+        max_connections=REDIS_MAX_CONNECTIONS,
         encoding="utf-8",
         decode_responses=True
     )
-    return redis
+    return pool
 
 # Authentication functions
 def create_access_token(data: dict):
@@ -89,110 +141,209 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+@lru_cache(maxsize=4096)
+def _verify_cached(token: str) -> TokenData:
+    # Only successfully verified tokens are cached, so expiry is checked by
+    # the caller; call _verify_cached.cache_clear() if SECRET_KEY changes
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    username: str = payload.get("sub")
+    if username is None:
+        raise HTTPException(status_code=401, detail="Invalid authentication token")
+    return TokenData(username=username, exp=payload.get("exp"))
+
 async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
     try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise HTTPException(status_code=401, detail="Invalid authentication token")
-        token_data = TokenData(username=username, exp=payload.get("exp"))
+        token_data = _verify_cached(credentials.credentials)
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token has expired")
     except jwt.JWTError:
         raise HTTPException(status_code=401, detail="Could not validate credentials")
+    if token_data.exp.timestamp() <= time.time():
+        raise HTTPException(status_code=401, detail="Token has expired")
     return token_data
 
+# Rate limiting
+class LocalTokenBucket:
+    def __init__(self):
+        self._hits: Dict[str, deque] = {}
+
+    def allow(self, key: str, rate: int, per: float) -> bool:
+        now = time.monotonic()
+        hits = self._hits.setdefault(key, deque())
+        while hits and now - hits[0] >= per:
+            hits.popleft()
+        if len(hits) >= rate:
+            return False
+        hits.append(now)
+        return True
+
+local_bucket = LocalTokenBucket()
+
+def rate_limiter(times: int, minutes: int):
+    # Trusted callers skip the Redis round-trip; their limit is enforced per
+    # worker, which is acceptable for a handful of known service accounts
+    redis_limiter = RateLimiter(times=times, minutes=minutes)
+
+    async def limit(request: Request, response: Response, token_data: TokenData = Depends(verify_token)):
+        if token_data.username in TRUSTED_USERNAMES:
+            key = f"{token_data.username}:{request.scope['route'].path}"
+            if not local_bucket.allow(key, times, minutes * 60):
+                raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Too Many Requests")
+            return
+        await redis_limiter(request, response)
+
+    return limit
+
+# The Groq client is created on startup and closed on shutdown, so every
+# app lifespan gets an open client
+def create_async_groq_client() -> AsyncGroq:
+    # HTTP/2 lets concurrent batch requests share one connection
+    return AsyncGroq(
+        api_key=os.getenv('GROQ_API_KEY'),
+        http_client=httpx.AsyncClient(limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT, http2=True)
+    )
+
 class MedicineGroqParser:
     def __init__(self):
-        self.client = Groq(
-            api_key=os.getenv('GROQ_API_KEY')
-        )
         self.model = "mixtral-8x7b-32768"
-        
-        self.strength_pattern = re.compile(
-            r'(\d+(?:\.\d+)?)\s*(?:micrograms|mcg|mg|g|ml|%)/(?:\d+(?:\.\d+)?)?\s*(?:ml|l)?|(\d+(?:\.\d+)?)\s*(?:micrograms|mcg|mg|g|ml)',
-            re.IGNORECASE
-        )
-        self.formulation_pattern = re.compile(
-            r'(tablets?|capsules?|(?:pre-filled\s+)?syringes?|(?:transdermal\s+)?patches?|oral\s+solution|suspension|cream|ointment|injection|powder|liquid|ampoules?|bottles?)',
-            re.IGNORECASE
-        )
+        # Set on startup once the Groq client and Redis connection are available
+        self.aclient = None
+        self.redis = None
+        # In-process cache in front of Redis
+        self._cache = LocalCache()
+        # Regex fast path hits and Groq requests actually sent
+        self._fast_hits = 0
+        self._llm_calls = 0
+
+    def _build_messages(self, medicine_string: str) -> List[Dict]:
+        return [_SYSTEM_MSG, {"role": "user", "content": _USER_TMPL.format(s=medicine_string)}]
+
+    def _parse_completion(self, completion, medicine_string: str) -> Optional[Dict]:
+        # Returns None when the reply is unusable so callers can fall back to
+        # the regex result without caching it
+        try:
+            response_text = completion.choices[0].message.content
+            if response_text.startswith('```json'):
+                response_text = response_text[7:-3]
+            result = orjson.loads(response_text)
+        except (orjson.JSONDecodeError, AttributeError) as e:
+            logger.error(f"Error parsing Groq response: {str(e)}")
+            return None
+
+        if not isinstance(result, dict):
+            logger.error(f"Groq response is not a JSON object: {response_text}")
+            return None
+
+        if not result.get('strength'):
+            strength_match = STRENGTH_RE.search(medicine_string)
+            result['strength'] = strength_match.group(0) if strength_match else ""
+
+        if not result.get('formulation'):
+            formulation_match = FORM_RE.search(medicine_string)
+            result['formulation'] = formulation_match.group(0) if formulation_match else ""
+
+        if not is_valid_components(result):
+            logger.error(f"Groq response is missing components: {response_text}")
+            return None
+
+        return result
 
-    @lru_cache(maxsize=1000)
-    def extract_components(self, medicine_string: str) -> Dict:
+    def extract_components_fast(self, medicine_string: str, fast: Optional[Dict] = None) -> Optional[Dict]:
+        # A regex result already computed for the batch is reused as is
+        extract = self.extract_components_regex if fast is None else (lambda _: fast)
+        components = fast_path_components(medicine_string, extract)
+        if components is not None:
+            self._fast_hits += 1
+        return components
+
+    @staticmethod
+    def _cache_key(medicine_string: str) -> str:
+        normalized = medicine_string.strip().lower()
+        return CACHE_PREFIX + hashlib.sha1(normalized.encode()).hexdigest()
+
+    async def _cache_get(self, key: str) -> Optional[Dict]:
+        if self.redis is None:
+            return None
         try:
-            prompt = f"""Given the medicine name "{medicine_string}", extract the following components:
-1. Medicine name (without strength and formulation)
-2. Strength (with units)
-3. Formulation
+            cached = await self.redis.get(key)
+            result = orjson.loads(cached) if cached else None
+        except Exception as e:
+            logger.error(f"Error reading from cache: {str(e)}")
+            return None
+        return result if is_valid_components(result) else None
 
-Return the result in JSON format like this:
-{{
-    "name": "medicine name",
-    "strength": "strength with units",
-    "formulation": "formulation type"
-}}
+    async def _cache_set(self, key: str, result: Dict) -> None:
+        if self.redis is None:
+            return
+        try:
+            await self.redis.set(key, orjson.dumps(result), ex=CACHE_TTL)
+        except Exception as e:
+            logger.error(f"Error writing to cache: {str(e)}")
 
-Be precise and only include the exact information present in the input."""
+    async def extract_components_async(self, medicine_string: str) -> Dict:
+        fast = self.extract_components_fast(medicine_string)
+        if fast is not None:
+            return fast
+        return await self.extract_components_llm_async(medicine_string)
+
+    async def extract_components_llm_async(self, medicine_string: str) -> Dict:
+        cached = self._cache.get(medicine_string)
+        if cached is not None:
+            return cached
 
-            completion = self.client.chat.completions.create(
+        key = self._cache_key(medicine_string)
+        cached = await self._cache_get(key)
+        if cached is not None:
+            self._cache.set(medicine_string, cached)
+            return cached
+
+        try:
+            self._llm_calls += 1
+            completion = await self.aclient.chat.completions.create(
                 model=self.model,
-                messages=[
-                    {"role": "system", "content": "You are an expert in parsing medical product names. Extract components accurately."},
-                    {"role": "user", "content": prompt}
-                ],
+                messages=self._build_messages(medicine_string),
                 temperature=0.0,
-                max_tokens=200
+                max_tokens=_MAX_TOKENS
             )
-
-            try:
-                response_text = completion.choices[0].message.content
-                if response_text.startswith('```json'):
-                    response_text = response_text[7:-3]
-                result = json.loads(response_text)
-                
-                if not result.get('strength'):
-                    strength_match = self.strength_pattern.search(medicine_string)
-                    result['strength'] = strength_match.group(0) if strength_match else ""
-                    
-                if not result.get('formulation'):
-                    formulation_match = self.formulation_pattern.search(medicine_string)
-                    result['formulation'] = formulation_match.group(0) if formulation_match else ""
-                
-                return result
-                
-            except (json.JSONDecodeError, AttributeError) as e:
-                logger.error(f"Error parsing Groq response: {str(e)}")
-                return self.extract_components_regex(medicine_string)
-            
+            result = self._parse_completion(completion, medicine_string)
         except Exception as e:
             logger.error(f"Error in Groq API call: {str(e)}")
+            result = None
+
+        # Regex fallbacks are returned but never cached
+        if result is None:
             return self.extract_components_regex(medicine_string)
 
+        self._cache.set(medicine_string, result)
+        await self._cache_set(key, result)
+        return result
+
     def extract_components_regex(self, medicine_string: str) -> Dict:
         try:
-            strength_match = self.strength_pattern.search(medicine_string)
-            strength = strength_match.group(0) if strength_match else ""
-
-            formulation_match = self.formulation_pattern.search(medicine_string)
-            formulation = formulation_match.group(0) if formulation_match else ""
-
-            name = medicine_string
-            if strength:
-                name = name.replace(strength, "")
-            if formulation:
-                name = name.replace(formulation, "")
-                
-            name = re.sub(r'^Generic\s+', '', name)
-            name = re.sub(r'\s+sterile\s+', ' ', name)
-            name = re.sub(r'\s+', ' ', name)
-            name = name.strip().rstrip(" -,.")
-
-            return {
-                "name": name,
-                "strength": strength,
-                "formulation": formulation
-            }
+            tokens, _ = _SCANNER.scan(medicine_string)
+            return components_from_tokens(tokens)
+        except Exception as e:
+            logger.error(f"Error in regex parsing: {str(e)}")
+            raise
+
+    def extract_components_regex_batch(self, medicine_strings: List[str]) -> List[Dict]:
+        joined = _BATCH_SEP.join(medicine_strings)
+        if joined.count(_BATCH_SEP) != len(medicine_strings) - 1:
+            # A name contains the separator itself, so scan one by one
+            return [self.extract_components_regex(s) for s in medicine_strings]
+
+        try:
+            tokens, _ = _SCANNER.scan(joined)
+            results = []
+            group = []
+            for token in tokens:
+                if token[0] == 'separator':
+                    results.append(components_from_tokens(group))
+                    group = []
+                else:
+                    group.append(token)
+            results.append(components_from_tokens(group))
+            return results
         except Exception as e:
             logger.error(f"Error in regex parsing: {str(e)}")
             raise
@@ -200,16 +351,26 @@ Be precise and only include the exact information present in the input."""
 # Initialize parser
 parser = MedicineGroqParser()
 
+async def bounded(semaphore: asyncio.Semaphore, coro):
+    async with semaphore:
+        return await coro
+
 # FastAPI startup and shutdown events
 @app.on_event("startup")
 async def startup():
     # Create Redis connection pool
-    app.state.redis = await create_redis_pool()
+    app.state.redis_pool = await create_redis_pool()
+    app.state.redis = aioredis.Redis(connection_pool=app.state.redis_pool)
     await FastAPILimiter.init(app.state.redis)
+    parser.redis = app.state.redis
+    parser.aclient = create_async_groq_client()
 
 @app.on_event("shutdown")
 async def shutdown():
     await app.state.redis.close()
+    await app.state.redis_pool.disconnect()
+    await parser.aclient.close()
+    parser.aclient = None
 
 # API endpoints
 @app.get("/")
@@ -229,12 +390,12 @@ async def parse_single_medicine(
     vpid: str, 
     name: str,
     token_data: TokenData = Depends(verify_token),
-    rate_limit: None = Depends(RateLimiter(times=10, minutes=1))
+    rate_limit: None = Depends(rate_limiter(times=10, minutes=1))
 ):
     try:
         logger.info(f"Processing single medicine request: VPID={vpid}, name={name}")
         
-        components = parser.extract_components(name)
+        components = await parser.extract_components_async(name)
         result = ParsedMedicine(
             VPID=vpid,
             original_name=name,
@@ -254,26 +415,55 @@ async def parse_single_medicine(
 async def parse_medicine_list(
     medicine_list: MedicineList,
     token_data: TokenData = Depends(verify_token),
-    rate_limit: None = Depends(RateLimiter(times=2, minutes=1))
+    rate_limit: None = Depends(rate_limiter(times=2, minutes=1))
 ):
     try:
         logger.info(f"Processing batch request with {len(medicine_list.medicines)} medicines")
         
+        # One tokenizer pass over the whole batch decides which medicines
+        # the regexes already cover; only the rest are sent to Groq
+        regex_results = parser.extract_components_regex_batch(
+            [medicine.NM for medicine in medicine_list.medicines]
+        )
+        results = [
+            parser.extract_components_fast(medicine.NM, regex_result)
+            for medicine, regex_result in zip(medicine_list.medicines, regex_results)
+        ]
+        # Names that normalize to the same cache key share one Groq request
+        pending: Dict[str, List[int]] = {}
+        for i, components in enumerate(results):
+            if components is None:
+                key = parser._cache_key(medicine_list.medicines[i].NM)
+                pending.setdefault(key, []).append(i)
+
+        if pending:
+            semaphore = asyncio.Semaphore(GROQ_CONCURRENCY)
+            tasks = [
+                bounded(semaphore, parser.extract_components_llm_async(medicine_list.medicines[indices[0]].NM))
+                for indices in pending.values()
+            ]
+            llm_results = await asyncio.gather(*tasks, return_exceptions=True)
+            for indices, components in zip(pending.values(), llm_results):
+                for i in indices:
+                    results[i] = components
+
         parsed_medicines = []
-        for medicine in medicine_list.medicines:
-            components = parser.extract_components(medicine.NM)
-            parsed_medicine = ParsedMedicine(
-                VPID=medicine.VPID,
-                original_name=medicine.NM,
-                name=components['name'],
-                strength=components['strength'],
-                formulation=components['formulation']
-            )
-            parsed_medicines.append(parsed_medicine)
-            time.sleep(0.1)  # Rate limiting
+        for medicine, components in zip(medicine_list.medicines, results):
+            if isinstance(components, Exception):
+                logger.error(f"Error processing medicine {medicine.VPID}: {str(components)}")
+                components = parser.extract_components_regex(medicine.NM)
+            # Plain dicts skip a second Pydantic validation pass on the response
+            parsed_medicines.append({
+                "VPID": medicine.VPID,
+                "original_name": medicine.NM,
+                "name": components['name'],
+                "strength": components['strength'],
+                "formulation": components['formulation']
+            })
             
         logger.info(f"Successfully processed batch of {len(parsed_medicines)} medicines")
-        return ParsedMedicineList(medicines=parsed_medicines)
+        logger.info(f"Regex fast path hits: {parser._fast_hits}, LLM calls: {parser._llm_calls}")
+        return ORJSONResponse({"medicines": parsed_medicines})
         
     except Exception as e:
         logger.error(f"Error processing batch: {str(e)}")
@@ -282,10 +472,20 @@ async def parse_medicine_list(
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
     logger.error(f"Global exception handler: {str(exc)}")
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
         content={"detail": "An unexpected error occurred"}
     )
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    # Reload mode only supports a single worker, so it is opt-in for development
+    reload = os.getenv('UVICORN_RELOAD', '').lower() in ('1', 'true', 'yes')
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=1 if reload else int(os.getenv('WEB_CONCURRENCY', 2)),
+        reload=reload
+    )
\ No newline at end of file
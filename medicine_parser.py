@@ -1,49 +1,96 @@
 import re
-import json
-from typing import List, Dict
+import orjson
+from typing import List, Dict, Iterator, Optional
 from pathlib import Path
 from groq import Groq
+import httpx
 import os
 from tqdm import tqdm
 import time
+from functools import lru_cache
+from medicine_patterns import (
+    STRENGTH_RE, FORM_RE, SCANNER, components_from_tokens,
+    fast_path_components, is_valid_components, LocalCache,
+    HTTP_LIMITS, HTTP_TIMEOUT
+)
+
+# Patch durations, written out or implied by the name
+_PATCH_DUR_RE = re.compile(
+    r'(?<!\d)(\d+(?:\.\d+)?)\s*(?:day|days|hour|hours|hr|hrs)',
+    re.IGNORECASE
+)
+_DURATION_RE = re.compile(r'(\d+)\s*(?:day|days|hour|hours|hr|hrs)')
+# Groq prompts; only the user message varies per medicine
+_SYSTEM_MSG = {"role": "system", "content": "You are an expert in parsing medical product names and understanding pharmaceutical formulations."}
+_USER_TMPL = """Given the medicine name "{s}", extract the following components:
+1. Medicine name (without strength and formulation)
+2. Strength (with units)
+3. Formulation
+4. If it's a patch, what is its duration in hours or days?
+
+Return the result in JSON format like this:
+{{
+    "name": "medicine name",
+    "strength": "strength with units",
+    "formulation": "formulation type",
+    "duration": "X hours or Y days for patches"
+}}
+
+Be precise and only include exact information from the input, except for patch duration which can come from medical knowledge."""
+_DURATION_SYSTEM_MSG = {"role": "system", "content": "You are an expert in pharmaceutical patches. Only respond with duration in format: X days or Y hours"}
+_DURATION_USER_TMPL = """For the medicine patch "{s}", what is its duration?
+Reply ONLY with the number followed by either 'hours' or 'days'. 
+For example: '7 days' or '24 hours'.
+If unsure, reply with 'unknown'."""
+# The reply is a small JSON object (four short fields), so a tight cap
+# keeps tail latency down
+_MAX_TOKENS = 100
+# Minimum spacing between the starts of consecutive Groq requests
+_GROQ_MIN_INTERVAL = 0.1
+
+@lru_cache(maxsize=None)
+def get_groq_client() -> Groq:
+    """Return the Groq client shared by every parser in this process"""
+    return Groq(
+        api_key=os.getenv('GROQ_API_KEY'),
+        http_client=httpx.Client(limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+    )
 
 class MedicineGroqParser:
     def __init__(self):
-        # Initialize Groq client
-        self.client = Groq(
-            api_key=os.getenv('GROQ_API_KEY')
-        )
+        # Shared Groq client
+        self.client = get_groq_client()
         
         # Model name
         self.model = "mixtral-8x7b-32768"
         
-        # Compile regex patterns
-        self.strength_pattern = re.compile(
-            r'(\d+(?:\.\d+)?)\s*(?:micrograms|mcg|mg|g|ml|%)/(?:\d+(?:\.\d+)?)?\s*(?:ml|l)?|(\d+(?:\.\d+)?)\s*(?:micrograms|mcg|mg|g|ml)',
-            re.IGNORECASE
-        )
-        self.formulation_pattern = re.compile(
-            r'(tablets?|capsules?|(?:pre-filled\s+)?syringes?|(?:transdermal\s+)?patches?|oral\s+solution|suspension|cream|ointment|injection|powder|liquid|ampoules?|bottles?)',
-            re.IGNORECASE
-        )
-        self.patch_duration_pattern = re.compile(
-            r'(\d+(?:\.\d+)?)\s*(?:day|days|hour|hours|hr|hrs)',
-            re.IGNORECASE
-        )
+        # Regex fast path hits and Groq requests actually sent
+        self._fast_hits = 0
+        self._llm_calls = 0
+
+        # Earliest time the next Groq request may start
+        self._next_request_at = time.monotonic()
+
+        # Cache of LLM results keyed only by the normalized name
+        self._cache = LocalCache()
+
+    def wait_for_rate_limit(self) -> None:
+        """Sleep only for whatever is left of the interval since the last request"""
+        slack = self._next_request_at - time.monotonic()
+        if slack > 0:
+            time.sleep(slack)
+        self._next_request_at = time.monotonic() + _GROQ_MIN_INTERVAL
 
     def get_patch_duration_from_llm(self, medicine_string: str) -> str:
         """Use LLM to determine patch duration and return only numeric value with unit"""
         try:
-            prompt = f"""For the medicine patch "{medicine_string}", what is its duration?
-Reply ONLY with the number followed by either 'hours' or 'days'. 
-For example: '7 days' or '24 hours'.
-If unsure, reply with 'unknown'."""
-
+            self.wait_for_rate_limit()
+            self._llm_calls += 1
             completion = self.client.chat.completions.create(
                 model=self.model,
                 messages=[
-                    {"role": "system", "content": "You are an expert in pharmaceutical patches. Only respond with duration in format: X days or Y hours"},
-                    {"role": "user", "content": prompt}
+                    _DURATION_SYSTEM_MSG,
+                    {"role": "user", "content": _DURATION_USER_TMPL.format(s=medicine_string)}
                 ],
                 temperature=0.0,
                 max_tokens=10
@@ -69,7 +116,7 @@ If unsure, reply with 'unknown'."""
         duration = duration.lower().strip()
         
         # Extract number and unit
-        match = re.match(r'(\d+)\s*(?:day|days|hour|hours|hr|hrs)', duration)
+        match = _DURATION_RE.match(duration)
         if match:
             number = match.group(1)
             if 'hour' in duration or 'hr' in duration:
@@ -77,96 +124,98 @@ If unsure, reply with 'unknown'."""
             return f"{number} days"
         return ""
 
-    def extract_components(self, medicine_string: str) -> Dict:
+    def extract_components_fast(self, medicine_string: str, is_patch: bool) -> Optional[Dict]:
+        """Return the regex result if it fully covers the medicine, else None"""
+        # Patches without an explicit duration would need the LLM anyway
+        if is_patch and not _PATCH_DUR_RE.search(medicine_string):
+            return None
+
+        fast = fast_path_components(
+            medicine_string, lambda s: self.extract_components_regex(s, is_patch)
+        )
+        if fast is not None:
+            self._fast_hits += 1
+        return fast
+
+    def extract_components(self, medicine_string: str, is_patch: Optional[bool] = None) -> Dict:
         """Extract medicine components using Groq API and regex patterns"""
-        try:
-            prompt = f"""Given the medicine name "{medicine_string}", extract the following components:
-1. Medicine name (without strength and formulation)
-2. Strength (with units)
-3. Formulation
-4. If it's a patch, what is its duration in hours or days?
+        if is_patch is None:
+            is_patch = 'patch' in medicine_string.lower()
 
-Return the result in JSON format like this:
-{{
-    "name": "medicine name",
-    "strength": "strength with units",
-    "formulation": "formulation type",
-    "duration": "X hours or Y days for patches"
-}}
+        fast = self.extract_components_fast(medicine_string, is_patch)
+        if fast is not None:
+            return fast
 
-Be precise and only include exact information from the input, except for patch duration which can come from medical knowledge."""
+        cached = self._cache.get(medicine_string)
+        if cached is not None:
+            return cached
 
+        try:
+            self.wait_for_rate_limit()
+            self._llm_calls += 1
             completion = self.client.chat.completions.create(
                 model=self.model,
                 messages=[
-                    {"role": "system", "content": "You are an expert in parsing medical product names and understanding pharmaceutical formulations."},
-                    {"role": "user", "content": prompt}
+                    _SYSTEM_MSG,
+                    {"role": "user", "content": _USER_TMPL.format(s=medicine_string)}
                 ],
                 temperature=0.0,
-                max_tokens=200
+                max_tokens=_MAX_TOKENS
             )
 
             try:
                 response_text = completion.choices[0].message.content
                 if response_text.startswith('```json'):
                     response_text = response_text[7:-3]
-                result = json.loads(response_text)
+                result = orjson.loads(response_text)
+                if not isinstance(result, dict):
+                    print("Error parsing Groq response: expected a JSON object")
+                    return self.extract_components_regex(medicine_string, is_patch)
                 
                 # Validate and clean results
                 if not result.get('strength'):
-                    strength_match = self.strength_pattern.search(medicine_string)
+                    strength_match = STRENGTH_RE.search(medicine_string)
                     result['strength'] = strength_match.group(0) if strength_match else ""
                     
                 if not result.get('formulation'):
-                    formulation_match = self.formulation_pattern.search(medicine_string)
+                    formulation_match = FORM_RE.search(medicine_string)
                     result['formulation'] = formulation_match.group(0) if formulation_match else ""
+
+                # Only validated replies are cached
+                if not is_valid_components(result):
+                    print("Error parsing Groq response: missing or non-string fields")
+                    return self.extract_components_regex(medicine_string, is_patch)
                 
                 # Handle patch duration
-                if 'patch' in medicine_string.lower():
-                    explicit_duration = self.patch_duration_pattern.search(medicine_string)
+                if is_patch:
+                    explicit_duration = _PATCH_DUR_RE.search(medicine_string)
                     if explicit_duration:
                         result['duration'] = self.clean_duration(explicit_duration.group(0))
                     elif not result.get('duration'):
                         result['duration'] = self.get_patch_duration_from_llm(medicine_string)
                 
+                self._cache.set(medicine_string, result)
                 return result
                 
-            except (json.JSONDecodeError, AttributeError) as e:
+            except (orjson.JSONDecodeError, AttributeError) as e:
                 print(f"Error parsing Groq response: {str(e)}")
-                return self.extract_components_regex(medicine_string)
+                return self.extract_components_regex(medicine_string, is_patch)
             
         except Exception as e:
             print(f"Error in Groq API call: {str(e)}")
-            return self.extract_components_regex(medicine_string)
+            return self.extract_components_regex(medicine_string, is_patch)
 
-    def extract_components_regex(self, medicine_string: str) -> Dict:
+    def extract_components_regex(self, medicine_string: str, is_patch: Optional[bool] = None) -> Dict:
         """Fallback method using only regex patterns"""
-        strength_match = self.strength_pattern.search(medicine_string)
-        strength = strength_match.group(0) if strength_match else ""
-
-        formulation_match = self.formulation_pattern.search(medicine_string)
-        formulation = formulation_match.group(0) if formulation_match else ""
-
-        name = medicine_string
-        if strength:
-            name = name.replace(strength, "")
-        if formulation:
-            name = name.replace(formulation, "")
-            
-        name = re.sub(r'^Generic\s+', '', name)
-        name = re.sub(r'\s+sterile\s+', ' ', name)
-        name = re.sub(r'\s+', ' ', name)
-        name = name.strip().rstrip(" -,.")
+        if is_patch is None:
+            is_patch = 'patch' in medicine_string.lower()
 
-        result = {
-            "name": name,
-            "strength": strength,
-            "formulation": formulation
-        }
+        tokens, _ = SCANNER.scan(medicine_string)
+        result = components_from_tokens(tokens)
 
         # For patches, try to get duration
-        if 'patch' in medicine_string.lower():
-            explicit_duration = self.patch_duration_pattern.search(medicine_string)
+        if is_patch:
+            explicit_duration = _PATCH_DUR_RE.search(medicine_string)
             if explicit_duration:
                 result['duration'] = self.clean_duration(explicit_duration.group(0))
             else:
@@ -174,12 +223,11 @@ Be precise and only include exact information from the input, except for patch d
 
         return result
 
-    def process_medicine_list(self, medicines: List[Dict]) -> List[Dict]:
-        """Process a list of medicines and extract components for each"""
-        processed_medicines = []
-        
+    def process_medicine_list(self, medicines: List[Dict]) -> Iterator[Dict]:
+        """Process a list of medicines and yield the components for each"""
         for medicine in tqdm(medicines, desc="Processing medicines"):
-            components = self.extract_components(medicine['NM'])
+            is_patch = 'patch' in medicine['NM'].lower()
+            components = self.extract_components(medicine['NM'], is_patch)
             processed_medicine = {
                 'VPID': medicine['VPID'],
                 'original_name': medicine['NM'],
@@ -189,13 +237,10 @@ Be precise and only include exact information from the input, except for patch d
             }
 
             # Add duration only for patches
-            if 'patch' in medicine['NM'].lower():
+            if is_patch:
                 processed_medicine['duration'] = components.get('duration', '')
             
-            processed_medicines.append(processed_medicine)
-            time.sleep(0.1)  # Rate limiting
-            
-        return processed_medicines
+            yield processed_medicine
 
 def process_file(input_file: str, output_file: str) -> None:
     """Read medicines from input JSON file, process them, and save to output JSON file"""
@@ -205,32 +250,46 @@ def process_file(input_file: str, output_file: str) -> None:
             raise ValueError("GROQ_API_KEY environment variable not set")
             
         # Read input file
-        with open(input_file, 'r') as f:
-            medicines = json.load(f)
-        
-        # Initialize parser and process medicines
-        parser = MedicineGroqParser()
-        processed_medicines = parser.process_medicine_list(medicines)
+        with open(input_file, 'rb') as f:
+            medicines = orjson.loads(f.read())
         
         # Create output directory if it doesn't exist
         output_path = Path(output_file)
         output_path.parent.mkdir(parents=True, exist_ok=True)
         
-        # Save results to output file
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(processed_medicines, f, indent=2, ensure_ascii=False)
+        # Initialize parser and stream results as they are produced, in the
+        # same layout as a single indented JSON array. They go to a temp file
+        # next to the output, which only replaces it once the run completes,
+        # so a failed or interrupted run leaves the previous output intact
+        parser = MedicineGroqParser()
+        sample = None
+        temp_path = output_path.with_name(output_path.name + '.tmp')
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(b'[')
+                for processed_medicine in parser.process_medicine_list(medicines):
+                    f.write(b',\n  ' if sample is not None else b'\n  ')
+                    f.write(orjson.dumps(processed_medicine, option=orjson.OPT_INDENT_2).replace(b'\n', b'\n  '))
+                    if sample is None:
+                        sample = processed_medicine
+                f.write(b'\n]' if sample is not None else b']')
+            os.replace(temp_path, output_path)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
             
         print(f"\nSuccessfully processed {len(medicines)} medicines.")
         print(f"Results saved to: {output_file}")
+        print(f"Regex fast path hits: {parser._fast_hits}, LLM calls: {parser._llm_calls}")
         
         # Print a sample of the results
-        if processed_medicines:
+        if sample is not None:
             print("\nSample output:")
-            print(json.dumps(processed_medicines[0], indent=2))
+            print(orjson.dumps(sample, option=orjson.OPT_INDENT_2).decode())
         
     except FileNotFoundError:
         print(f"Error: Input file '{input_file}' not found.")
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         print(f"Error: Invalid JSON format in input file '{input_file}'.")
     except Exception as e:
         print(f"Error: An unexpected error occurred: {str(e)}")
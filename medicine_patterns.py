@@ -0,0 +1,127 @@
+import re
+import threading
+import httpx
+from typing import Callable, Dict, List, Optional
+
+# Compiled once per process and shared by the API and the CLI parser. Numbers
+# are anchored with (?<!\d) so a long digit run is tried once from its first
+# digit instead of from every position, which keeps matching linear; the
+# leftmost match is the same either way
+STRENGTH_RE = re.compile(
+    r'(?<!\d)(\d+(?:\.\d+)?)\s*(?:micrograms|mcg|mg|g|ml|%)/(?:\d+(?:\.\d+)?)?\s*(?:ml|l)?|(?<!\d)(\d+(?:\.\d+)?)\s*(?:micrograms|mcg|mg|g|ml)',
+    re.IGNORECASE
+)
+FORM_RE = re.compile(
+    r'(tablets?|capsules?|(?:pre-filled\s+)?syringes?|(?:transdermal\s+)?patches?|oral\s+solution|suspension|cream|ointment|injection|powder|liquid|ampoules?|bottles?)',
+    re.IGNORECASE
+)
+# Single left-to-right tokenizer for strength, formulation and the rest of
+# the name; letter runs are kept whole so formulations only match at word
+# starts, and whitespace is kept so the name keeps its original spacing
+TOKEN_RULES = [
+    (STRENGTH_RE.pattern, lambda scanner, token: ('strength', token)),
+    (FORM_RE.pattern, lambda scanner, token: ('formulation', token)),
+    (r'[^\W\d_]+|\S', lambda scanner, token: ('text', token)),
+    (r'\s+', lambda scanner, token: ('text', token)),
+]
+SCANNER = re.Scanner(TOKEN_RULES, re.IGNORECASE)
+# Fused name cleanups
+_CLEANUP_RE = re.compile(r'^Generic\s+|\s+sterile\s+|\s+')
+
+def _cleanup_replacement(match: re.Match) -> str:
+    return '' if match.group(0).startswith('Generic') else ' '
+
+def components_from_tokens(tokens: List) -> Dict:
+    strength = ""
+    formulation = ""
+    parts = []
+    # The first strength and formulation are extracted and every repeat of
+    # the same text is dropped from the name
+    for kind, text in tokens:
+        if kind == 'strength':
+            strength = strength or text
+            if text == strength:
+                continue
+        elif kind == 'formulation':
+            formulation = formulation or text
+            if text == formulation:
+                continue
+        parts.append(text)
+
+    name = _CLEANUP_RE.sub(_cleanup_replacement, "".join(parts))
+    name = name.strip().rstrip(" -,.")
+
+    return {
+        "name": name,
+        "strength": strength,
+        "formulation": formulation
+    }
+
+# Cheap features predicting whether the regex result can be trusted without
+# the LLM. Each feature vector indexes a bit in _FAST_PATH_OK; the table comes
+# from comparing regex output with Groq output on the sample in
+# api_output.json: per-time strengths (micrograms/hour, mg/24hours) and
+# multi-ingredient names ("A 40mg/4ml / B 12mg/4ml") disagree, while plain
+# names agree even without a strength as long as there is no digit at all
+_HAS_DIGIT = 1
+_HAS_RATE = 2
+_HAS_COMBINATION = 4
+_DIGIT_RE = re.compile(r'\d')
+_RATE_RE = re.compile(r'/\s*\d*\s*(?:hours?|hrs?|days?|dose)', re.IGNORECASE)
+_COMBINATION_RE = re.compile(r'\s/\s')
+_FAST_PATH_OK = (1 << 0) | (1 << _HAS_DIGIT)
+
+def _fast_path_features(medicine_string: str) -> int:
+    features = 0
+    if _DIGIT_RE.search(medicine_string):
+        features |= _HAS_DIGIT
+    if _RATE_RE.search(medicine_string):
+        features |= _HAS_RATE
+    if _COMBINATION_RE.search(medicine_string):
+        features |= _HAS_COMBINATION
+    return features
+
+def fast_path_components(medicine_string: str, extract: Callable[[str], Dict]) -> Optional[Dict]:
+    """Return the regex result if it fully covers the medicine, else None"""
+    # Well-formed dm+d strings are fully covered by the regexes, so the LLM
+    # is only needed when strength or formulation is missing, or when the
+    # string has a shape the regexes are known to get wrong. extract only
+    # runs for strings that pass the feature gate
+    features = _fast_path_features(medicine_string)
+    if not (_FAST_PATH_OK >> features) & 1:
+        return None
+
+    components = extract(medicine_string)
+    if components['formulation'] and (components['strength'] or not features & _HAS_DIGIT):
+        return components
+    return None
+
+def is_valid_components(result) -> bool:
+    return isinstance(result, dict) and all(
+        isinstance(result.get(field), str) for field in ('name', 'strength', 'formulation')
+    )
+
+# Parsed results kept per process, keyed by the normalized name
+LOCAL_CACHE_SIZE = 1000
+
+class LocalCache:
+    """Lock-guarded in-process cache that evicts the oldest entry once full"""
+
+    def __init__(self, maxsize: int = LOCAL_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._data: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    def get(self, medicine_string: str) -> Optional[Dict]:
+        return self._data.get(medicine_string.strip().lower())
+
+    def set(self, medicine_string: str, result: Dict) -> None:
+        key = medicine_string.strip().lower()
+        with self._lock:
+            if key not in self._data and len(self._data) >= self.maxsize:
+                self._data.pop(next(iter(self._data)))
+            self._data[key] = result
+
+# Groq HTTP connections are pooled and kept alive across requests
+HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+HTTP_TIMEOUT = httpx.Timeout(10.0, connect=2.0)